@@ -1,18 +1,39 @@
 # ------------------ IMPORTS ------------------
 import os
+import io
+import argparse
+import sys
 import json
-import time
+import atexit
+import signal
+import threading
 from pathlib import Path
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pv
+from pgpq import ArrowToPostgresBinaryEncoder
 import requests
 import requests_cache
-from difflib import SequenceMatcher
+from rapidfuzz import fuzz, process
 from sqlalchemy import create_engine, text
+from psycopg2.extras import execute_values
 from requests.adapters import HTTPAdapter, Retry
 from urllib.parse import quote_plus
 from dotenv import load_dotenv
 
 
+# ------------------ COMMAND LINE ------------------
+parser = argparse.ArgumentParser(description="MovieLens + OMDb ETL pipeline")
+parser.add_argument(
+    "--fresh-load",
+    action="store_true",
+    help="drop secondary indexes on rating/movie_genre during the load and rebuild them afterwards"
+)
+args = parser.parse_args()
+
+
 # ------------------ LOAD ENVIRONMENT VARIABLES ------------------
 load_dotenv()
 
@@ -37,10 +58,22 @@ DATABASE_URL = (
 # ------------------ CONSTANTS ------------------
 MAX_REQUESTS_PER_DAY = 1000
 PROGRESS_FILE = "progress.json"
+TITLE_CACHE_FILE = "title_cache.json"
+MAX_WORKERS = 16
+CHUNK_SIZE = 200
+
+# non-unique indexes from schema.sql, dropped and rebuilt around a --fresh-load
+BULK_LOAD_INDEXES = {
+    "idx_rating_user":      "CREATE INDEX idx_rating_user ON rating(user_id)",
+    "idx_rating_movie":     "CREATE INDEX idx_rating_movie ON rating(movie_id)",
+    "idx_moviegenre_movie": "CREATE INDEX idx_moviegenre_movie ON movie_genre(movie_id)",
+    "idx_moviegenre_genre": "CREATE INDEX idx_moviegenre_genre ON movie_genre(genre_id)",
+}
 
 
 # ------------------ HTTP SESSION + CACHE ------------------
-requests_cache.install_cache("omdb_cache", backend="sqlite", expire_after=None)
+# one JSON file per response: cache hits skip SQLite's SELECT + locking across worker threads
+requests_cache.install_cache("omdb_cache", backend="filesystem", serializer="json", expire_after=None)
 
 session = requests.Session()
 retry_config = Retry(
@@ -49,126 +82,287 @@ retry_config = Retry(
     status_forcelist=[429, 500, 502, 503, 504],
     allowed_methods=["GET"]
 )
-session.mount("http://", HTTPAdapter(max_retries=retry_config))
-session.mount("https://", HTTPAdapter(max_retries=retry_config))
+session.mount("http://", HTTPAdapter(max_retries=retry_config, pool_maxsize=MAX_WORKERS))
+session.mount("https://", HTTPAdapter(max_retries=retry_config, pool_maxsize=MAX_WORKERS))
+
+# shared across worker threads
+requests_used = 0
+quota_lock = threading.Lock()
+title_key_cache = {}  # clean(title) -> last matching title-only OMDB response
 
 
 # ------------------ DB CONNECTION ------------------
 engine = create_engine(DATABASE_URL, pool_pre_ping=True)
 
 
-# ------------------ HELPER FUNCTION ------------------
-def extract_title_year(full_title: str):
-    """Extract Title and Year from 'Movie (1995)'."""
-    if "(" in full_title and ")" in full_title[-5:]:
-        return full_title.rsplit("(", 1)[0].strip(), full_title[-5:-1]
-    return full_title, None
+# ------------------ HELPER FUNCTIONS ------------------
+_PUNCT_TBL = str.maketrans("", "", ",':-.")
 
 
-# ------------------ EXTRACT ------------------
-print("\n=== EXTRACT PHASE ===")
+def clean(t):
+    """Normalise a title for comparison (lowercase, no punctuation)."""
+    return t.lower().translate(_PUNCT_TBL).strip()
 
-movies = pd.read_csv("movies.csv")
-ratings = pd.read_csv("ratings.csv")
 
-movies["Director"] = None
-movies["Plot"] = None
-movies["BoxOffice"] = None
+class QuotaExhausted(Exception):
+    """Raised once the daily OMDB request budget is used up."""
 
-# resume progress
-start_index = 0
-if Path(PROGRESS_FILE).exists():
-    start_index = json.loads(Path(PROGRESS_FILE).read_text()).get("last_index", 0)
 
-print(f"Resuming from movie index {start_index}")
+def omdb_get(params):
+    """GET from OMDB, counting non-cached calls against the daily quota."""
+    global requests_used
+    params = {"apikey": OMDB_API_KEY, **params}
 
-requests_used = 0
-fuzzy_log = []
+    # cache hits are free, so serve them without touching the quota
+    # (a miss comes back as a synthetic 504 with an empty body)
+    r = session.get(OMDB_URL, params=params, timeout=6, only_if_cached=True)
+    if r.status_code != 504:
+        return r.json()
 
+    # reserve a slot before the network call so concurrent workers never overshoot the quota
+    with quota_lock:
+        if requests_used >= MAX_REQUESTS_PER_DAY:
+            raise QuotaExhausted
+        requests_used += 1
 
-for index in range(start_index, len(movies)):
+    r = session.get(OMDB_URL, params=params, timeout=6)
 
-    if requests_used >= MAX_REQUESTS_PER_DAY:
-        print("\nDAILY LIMIT REACHED (1000 requests). Come back tomorrow.")
-        break
+    # another worker may have cached the same URL in the meantime
+    if getattr(r, "from_cache", False):
+        with quota_lock:
+            requests_used -= 1
 
-    title, year = extract_title_year(movies.at[index, "title"])
+    return r.json()
 
-    # Exact match (title + year)
-    r = session.get(OMDB_URL, params={"apikey": OMDB_API_KEY, "t": title, "y": year}, timeout=6)
 
-    if not getattr(r, "from_cache", False):
-        requests_used += 1
+def omdb_fields(data):
+    """Pick the enrichment columns out of an OMDB response."""
+    return {
+        "Director":  data.get("Director"),
+        "Plot":      data.get("Plot"),
+        "BoxOffice": data.get("BoxOffice"),
+    }
 
-    data = r.json()
-    
-    if data.get("Response") == "True":
-        print(f"Exact: {title} ({year})")
-        movies.at[index, "Director"]   = data.get("Director")
-        movies.at[index, "Plot"]       = data.get("Plot")
-        movies.at[index, "BoxOffice"]  = data.get("BoxOffice")
-        continue
 
-    else:
-        # Title-only fallback
-        r = session.get(OMDB_URL, params={"apikey": OMDB_API_KEY, "t": title}, timeout=6)
-        if not getattr(r, "from_cache", False):
-         requests_used += 1
+def remember(title_key, data):
+    """Keep the parts of a matching title-only response needed to replay it.
+
+    Only fed from the `{"t": title}` call: exact responses are tied to one
+    year and would leak onto remakes sharing the cleaned title.
+    """
+    title_key_cache[title_key] = {
+        "Response": "True",
+        "Title": data.get("Title", ""),
+        "Year": data.get("Year"),
+        **omdb_fields(data),
+    }
+
+
+def fetch_one(index, title, year, title_key):
+    """Run the exact -> title-only -> fuzzy search cascade for one movie.
+
+    `title_key` is clean(title), precomputed for the whole frame.
+    """
+    result = {"index": index, "enrichment": None, "fuzzy": None, "path": None}
 
-        data = r.json()
+    # Exact match (title + year); without a year it would repeat the title-only call
+    if year is not None:
+        data = omdb_get({"t": title, "y": year})
 
         if data.get("Response") == "True":
+            print(f"Exact: {title} ({year})")
+            result["enrichment"] = omdb_fields(data)
+            result["path"] = "exact"
+            return result
 
-            returned_title = data.get("Title", "")
-
-            def clean(t):
-                return (
-                    t.lower()
-                     .replace(",", "")
-                     .replace("'", "")
-                     .replace(":", "")
-                     .replace("-", "")
-                     .replace(".", "")
-                     .strip()
-                )
-
-            if clean(returned_title) == clean(title):
-                print(f"Title-only exact match: {title} == {returned_title}")
-                movies.at[index, "Director"]  = data.get("Director")
-                movies.at[index, "Plot"]      = data.get("Plot")
-                movies.at[index, "BoxOffice"] = data.get("BoxOffice")
-                continue  # do not go to fuzzy mode
-
-            else:
-                print(f"Title mismatch logged: CSV:`{title}` → API:`{returned_title}`")
-                fuzzy_log.append({
-                    "CSV Title": title,
-                    "Suggested Match": returned_title,
-                    "Year": data.get("Year"),
-                    "Score": SequenceMatcher(None, title.lower(), returned_title.lower()).ratio()
-                })
+    # Title-only fallback, skipped when the same cleaned title already matched
+    data = title_key_cache.get(title_key)
+    if data is None:
+        data = omdb_get({"t": title})
 
+    if data.get("Response") == "True":
+
+        returned_title = data.get("Title", "")
+
+        if clean(returned_title) == title_key:
+            print(f"Title-only exact match: {title} == {returned_title}")
+            result["enrichment"] = omdb_fields(data)
+            result["path"] = "title-only"
+            remember(title_key, data)
         else:
-            #Fuzzy search
-            r = session.get(OMDB_URL, params={"apikey": OMDB_API_KEY, "s": title}, timeout=6)
-            if not getattr(r, "from_cache", False):
-             requests_used += 1
-            data = r.json()
-
-            if data.get("Response") == "True":
-                best = max(data["Search"], key=lambda m: SequenceMatcher(None, title, m["Title"]).ratio())
-                score = SequenceMatcher(None, title, best["Title"]).ratio()
-
-                print(f"Fuzzy match: {title} → {best['Title']} (score={score:.2f})")
-                fuzzy_log.append({
-                    "CSV Title": title,
-                    "Suggested Match": best["Title"],
-                    "Year": best["Year"],
-                    "Score": score
-                })
-
-    Path(PROGRESS_FILE).write_text(json.dumps({"last_index": index}))
-    time.sleep(0.05)
+            print(f"Title mismatch logged: CSV:`{title}` → API:`{returned_title}`")
+            result["fuzzy"] = {
+                "CSV Title": title,
+                "Suggested Match": returned_title,
+                "Year": data.get("Year"),
+                "Score": fuzz.ratio(title.lower(), returned_title.lower()) / 100.0
+            }
+            result["path"] = "mismatch"
+        return result  # do not go to fuzzy mode
+
+    # Fuzzy search
+    data = omdb_get({"s": title})
+
+    if data.get("Response") == "True":
+        _, score, best_idx = process.extractOne(title, [m["Title"] for m in data["Search"]], scorer=fuzz.ratio)
+        best = data["Search"][best_idx]
+        score /= 100.0
+
+        print(f"Fuzzy match: {title} → {best['Title']} (score={score:.2f})")
+        result["fuzzy"] = {
+            "CSV Title": title,
+            "Suggested Match": best["Title"],
+            "Year": best["Year"],
+            "Score": score
+        }
+        result["path"] = "fuzzy"
+
+    return result
+
+
+def save_progress():
+    """Flush the resume checkpoint and the title cache to disk."""
+    Path(PROGRESS_FILE).write_text(json.dumps({"last_index": last_index}))
+    Path(TITLE_CACHE_FILE).write_text(json.dumps(dict(title_key_cache)))
+
+
+def abort(signum, frame):
+    """Drop queued lookups and exit; atexit then flushes progress."""
+    executor.shutdown(wait=False, cancel_futures=True)
+    sys.exit(128 + signum)
+
+
+def copy_frame(cur, df, table):
+    """Stream a DataFrame into `table` with COPY (columns matched by name)."""
+    buf = io.StringIO()
+    df.to_csv(buf, index=False, header=False)
+    buf.seek(0)
+    cur.copy_expert(f"COPY {table} ({', '.join(df.columns)}) FROM STDIN WITH (FORMAT CSV)", buf)
+
+
+def copy_frame_binary(cur, df, table):
+    """Create temp `table` typed from the DataFrame and fill it with binary COPY (pgpq)."""
+    arrow = pa.Table.from_pandas(df, preserve_index=False)
+
+    # pandas timestamps are ns, which pgpq rejects; Postgres only keeps us anyway
+    arrow = arrow.cast(pa.schema([
+        field.with_type(pa.timestamp("us", field.type.tz)) if pa.types.is_timestamp(field.type) else field
+        for field in arrow.schema
+    ]))
+    encoder = ArrowToPostgresBinaryEncoder(arrow.schema)
+
+    # binary COPY needs exact column types, so the stage takes pgpq's inferred ones
+    cols = ", ".join(f"{name} {col.data_type.ddl()}" for name, col in encoder.schema().columns)
+    cur.execute(f"CREATE TEMP TABLE {table} ({cols}) ON COMMIT DROP")
+
+    buf = io.BytesIO()
+    buf.write(encoder.write_header())
+    for batch in arrow.to_batches():
+        buf.write(encoder.write_batch(batch))
+    buf.write(encoder.finish())
+    buf.seek(0)
+    cur.copy_expert(f"COPY {table} FROM STDIN WITH (FORMAT BINARY)", buf)
+
+
+# ------------------ EXTRACT ------------------
+print("\n=== EXTRACT PHASE ===")
+
+movies = pd.read_csv("movies.csv")
+# ratings is the big file: Arrow's multi-threaded CSV reader, then hand the columns to pandas
+ratings = pv.read_csv("ratings.csv").to_pandas(split_blocks=True, self_destruct=True)
+
+# split 'Movie (1995)' into title/year and build the comparison key in one pass per column
+movies["_year"] = movies["title"].str.extract(r"\((\d{4})\)\s*$", expand=False)
+movies["_title_clean"] = movies["title"].str.replace(r"\s*\(\d{4}\)\s*$", "", regex=True).str.strip()
+movies["_title_key"] = movies["_title_clean"].str.lower().str.translate(_PUNCT_TBL).str.strip()
+
+# resume progress
+start_index = 0
+if Path(PROGRESS_FILE).exists():
+    start_index = json.loads(Path(PROGRESS_FILE).read_text()).get("last_index", 0)
+
+if Path(TITLE_CACHE_FILE).exists():
+    title_key_cache.update(json.loads(Path(TITLE_CACHE_FILE).read_text()))
+
+print(f"Resuming from movie index {start_index}")
+
+# checkpoint is kept in memory and written once per chunk, on exit, or on Ctrl+C / kill
+last_index = start_index
+atexit.register(save_progress)
+
+fuzzy_log = []
+results = []
+path_hits = Counter()  # which step of the cascade resolved each movie
+
+# movies already enriched in the database never need another OMDB call
+enriched_ids = set(pd.read_sql(
+    text("SELECT movie_id FROM movie WHERE director IS NOT NULL OR plot IS NOT NULL"), engine
+)["movie_id"])
+remaining = movies.loc[start_index:]
+todo = remaining[~remaining["movieId"].isin(enriched_ids)]
+print(f"Skipping {len(remaining) - len(todo)} movies already enriched in the database")
+
+tasks = [
+    (index, title, year if pd.notna(year) else None, title_key)
+    for index, title, year, title_key
+    in todo[["_title_clean", "_year", "_title_key"]].itertuples(name=None)
+]
+
+with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+
+    # only the fetch loop gets the abort handlers; TRANSFORM/LOAD keep the defaults
+    previous_handlers = {sig: signal.signal(sig, abort) for sig in (signal.SIGINT, signal.SIGTERM)}
+
+    for chunk_start in range(0, len(tasks), CHUNK_SIZE):
+
+        if requests_used >= MAX_REQUESTS_PER_DAY:
+            print("\nDAILY LIMIT REACHED (1000 requests). Come back tomorrow.")
+            break
+
+        chunk = tasks[chunk_start:chunk_start + CHUNK_SIZE]
+        futures = {executor.submit(fetch_one, *task): task[0] for task in chunk}
+        unfinished = []
+        failed = []
+
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except QuotaExhausted:
+                unfinished.append(futures[future])
+                continue
+            except (requests.RequestException, ValueError) as e:
+                # retries are exhausted or the body is not JSON: leave the movie for the next run
+                print(f"OMDB lookup failed for movie index {futures[future]}: {e}")
+                failed.append(futures[future])
+                continue
+
+            path_hits[result["path"] or "no match"] += 1
+
+            if result["enrichment"]:
+                results.append({"movieId": movies.at[result["index"], "movieId"], **result["enrichment"]})
+            if result["fuzzy"]:
+                fuzzy_log.append(result["fuzzy"])
+
+        # resume from the first movie the quota or an error cut off, otherwise after this chunk
+        last_index = min(unfinished + failed) if unfinished or failed else chunk[-1][0] + 1
+        save_progress()
+
+        if unfinished:
+            print("\nDAILY LIMIT REACHED (1000 requests). Come back tomorrow.")
+            break
+        if failed:
+            print(f"\n{len(failed)} OMDB lookups failed. Stopping here; the next run retries them.")
+            break
+
+for sig, handler in previous_handlers.items():
+    signal.signal(sig, handler)
+
+print("\nLookup paths: " + ", ".join(f"{path}={n}" for path, n in path_hits.most_common()))
+
+# single merge instead of per-row .at writes from the loop
+enriched = pd.DataFrame(results, columns=["movieId", "Director", "Plot", "BoxOffice"])
+enriched = enriched.astype({"movieId": movies["movieId"].dtype})
+movies = movies.merge(enriched, on="movieId", how="left")
 
     # save fuzzy log after each batch update
 if fuzzy_log:
@@ -187,14 +381,13 @@ print("\n=== TRANSFORM PHASE ===")
 ratings["timestamp"] = pd.to_datetime(ratings["timestamp"], unit="s")
 
 movies["release_year"] = movies["title"].str.extract(r"\((\d{4})\)").astype("Int64")
-movies["decade"] = movies["release_year"].apply(
-    lambda y: f"{int(y)//10*10}s" if pd.notna(y) else None
-)
+# NA years stay NA through the string concat
+movies["decade"] = ((movies["release_year"] // 10) * 10).astype("string") + "s"
 
-movie_genres = movies[["movieId", "genres"]].copy()
-movie_genres.loc[:, "genre"] = movie_genres["genres"].str.split("|")
-movie_genres = movie_genres.explode("genre")
-movie_genres["genre"] = movie_genres["genre"].str.strip()
+# one indicator column per genre, then keep the (movieId, genre) pairs that are set
+dummies = movies.set_index("movieId")["genres"].str.get_dummies(sep="|")
+dummies.columns.name = "genre"
+movie_genres = dummies.stack(future_stack=True).loc[lambda flags: flags == 1].reset_index()[["movieId", "genre"]]
 
 users = ratings["userId"].unique().tolist()
 genres = pd.unique(movie_genres["genre"])
@@ -205,45 +398,80 @@ print("\n=== LOAD PHASE ===")
 
 with engine.begin() as conn:
 
-    conn.execute(text("""
+    # don't wait for the commit record to be flushed. A server crash just after COMMIT can
+    # lose this batch without corrupting earlier ones, but progress.json has already moved
+    # past these movies, so their enrichment is not re-fetched unless progress.json is reset
+    conn.execute(text("SET LOCAL synchronous_commit = off"))
+
+    # cold loads: build these once from sorted data instead of maintaining them per row;
+    # unique indexes stay since ON CONFLICT relies on them
+    if args.fresh_load:
+        for name in BULK_LOAD_INDEXES:
+            conn.execute(text(f"DROP INDEX IF EXISTS {name}"))
+
+    cur = conn.connection.cursor()
+
+    execute_values(cur, """
         INSERT INTO user_t (user_id, username)
-        VALUES (:uid, :uname)
+        VALUES %s
         ON CONFLICT (user_id) DO NOTHING;
-    """), [{"uid": int(uid), "uname": f"User_{uid}"} for uid in users])
+    """, [(int(uid), f"User_{uid}") for uid in users], page_size=10000)
 
-    conn.execute(text("""
+    execute_values(cur, """
         INSERT INTO genre (genre_name)
-        VALUES (:g)
+        VALUES %s
         ON CONFLICT (genre_name) DO NOTHING;
-    """), [{"g": g} for g in genres])
-
-    conn.execute(text("""
-        INSERT INTO movie (movie_id, title, release_year, director, plot, box_office, decade)
-        VALUES (:mid, :title, :release_year, :director, :plot, :box_office, :decade)
-        ON CONFLICT (movie_id) DO NOTHING;
-    """), movies.rename(columns={
-        "movieId": "mid",
+    """, [(g,) for g in genres], page_size=10000)
+
+    # COPY into temp stage tables, then INSERT ... SELECT to keep ON CONFLICT DO NOTHING
+    cur.execute("""
+        CREATE TEMP TABLE movie_stage ON COMMIT DROP AS
+        SELECT movie_id, title, release_year, director, plot, box_office, decade
+        FROM movie WITH NO DATA;
+    """)
+    copy_frame(cur, movies.rename(columns={
+        "movieId": "movie_id",
         "Director": "director",
         "Plot": "plot",
         "BoxOffice": "box_office"
-    })[["mid", "title", "release_year", "director", "plot", "box_office", "decade"]]
-    .to_dict(orient="records"))
-
-    for _, row in movie_genres.iterrows():
-        conn.execute(text("""
-            INSERT INTO movie_genre (movie_id, genre_id)
-            VALUES (
-                :mid,
-                (SELECT genre_id FROM genre WHERE genre_name = :g)
-            )
-            ON CONFLICT (movie_id, genre_id) DO NOTHING;
-        """), {"mid": int(row.movieId), "g": row.genre})
-
-    conn.execute(text("""
+    })[["movie_id", "title", "release_year", "director", "plot", "box_office", "decade"]], "movie_stage")
+    cur.execute("""
+        INSERT INTO movie (movie_id, title, release_year, director, plot, box_office, decade)
+        SELECT movie_id, title, release_year, director, plot, box_office, decade FROM movie_stage
+        ON CONFLICT (movie_id) DO NOTHING;
+    """)
+
+    # resolve genre ids client-side from one lookup so movie_genre rows are loaded as-is
+    id_map = dict(conn.execute(text("SELECT genre_name, genre_id FROM genre")).all())
+    mg = pd.DataFrame({
+        "movie_id": movie_genres["movieId"],
+        "genre_id": movie_genres["genre"].map(id_map),
+    })
+
+    cur.execute("""
+        CREATE TEMP TABLE movie_genre_stage ON COMMIT DROP AS
+        SELECT movie_id, genre_id
+        FROM movie_genre WITH NO DATA;
+    """)
+    copy_frame(cur, mg, "movie_genre_stage")
+    cur.execute("""
+        INSERT INTO movie_genre (movie_id, genre_id)
+        SELECT movie_id, genre_id FROM movie_genre_stage
+        ON CONFLICT (movie_id, genre_id) DO NOTHING;
+    """)
+
+    # ratings is the largest table and all numeric/timestamp: binary COPY skips text parsing
+    copy_frame_binary(cur, ratings.rename(columns={"userId": "user_id", "movieId": "movie_id", "timestamp": "rating_ts"})
+                      [["user_id", "movie_id", "rating", "rating_ts"]], "rating_stage")
+    cur.execute("""
         INSERT INTO rating (user_id, movie_id, rating, rating_ts)
-        VALUES (:uid, :mid, :rating, :ts)
+        SELECT user_id, movie_id, rating, rating_ts FROM rating_stage
         ON CONFLICT DO NOTHING;
-    """), ratings.rename(columns={"userId": "uid", "movieId": "mid", "timestamp": "ts"}).to_dict(orient="records"))
+    """)
+
+    if args.fresh_load:
+        for ddl in BULK_LOAD_INDEXES.values():
+            cur.execute(ddl)
 
 print("\nETL COMPLETE — Loaded today's batch into PostgreSQL.")
 print(" Come back tomorrow, script resumes automatically.")